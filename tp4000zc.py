@@ -1,4 +1,50 @@
+from __future__ import print_function
+
+import array
+import os
 import serial
+import struct
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # not a posix system (ie windows), low latency mode isn't available
+    fcntl = termios = None
+
+
+def _buildDigitLut(digitTable):
+    """
+    Expand digitTable into a flat 256 entry list indexed by the two data
+    nibbles of a digit packed into a byte, holding (highBit, digit).
+    Unknown segment patterns map to 'X'.
+    """
+    lut = [(i >> 7, 'X') for i in range(256)]
+    for (b1, b2), ch in digitTable.items():
+        lut[(b1 << 4) | b2] = (0, ch)
+        lut[((b1 | 8) << 4) | b2] = (1, ch)
+    return lut
+
+
+def _buildAttribLut(bits):
+    """
+    For each flag byte in bits, precompute the (attr, val) pairs that are set
+    for every one of the 16 possible data nibbles.  The first pair in bits
+    is the high bit of the nibble.
+    """
+    return tuple(
+        (k, tuple(tuple(flag for i, flag in enumerate(flags) if n & (8 >> i))
+                  for n in range(16)))
+        for k, flags in bits)
 
 
 class Dmm:
@@ -23,10 +69,10 @@ class Dmm:
     # read a value
     val = dmm.read()
     
-    print val.text       # print the text representation of the value
-                         # something like: -4.9 millivolts DC
-    print val.numericVal # and the numeric value
-                         # ie: -0.0048
+    print(val.text)       # print the text representation of the value
+                          # something like: -4.9 millivolts DC
+    print(val.numericVal) # and the numeric value
+                          # ie: -0.0048
     # recycle the serial port
     dmm.close()
 
@@ -37,9 +83,15 @@ class Dmm:
         initialize it and read enough from the serial port to synchronize 
         the module with the start/end of a full reading.
 
-    read():
+    read(lazyText=False):
         Attempt to get a complete reading off of the serial port, parse it and
         return an instance of DmmValue holding the interpretted reading.
+        With lazyText the DmmValue only builds its text when it's first used.
+
+    iterReadings(lazyText=False):
+        Generator yielding a DmmValue for each reading as it arrives.  The
+        serial port is read in a background thread so that reading continues
+        while the caller handles the previous value.
 
     close():
         Finally you can close the serial port connection with close()
@@ -89,6 +141,12 @@ class Dmm:
     """
 
     bytesPerRead = 14
+    syncGap = 0.05 # seconds of silence that mark the gap between readings
+
+    # to validate a frame its position nibbles are checked as little endian
+    # 8, 4 and 2 byte words rather than one byte at a time.
+    frameWords = struct.Struct('<QIH')
+    frameSync = frameWords.unpack(bytes(bytearray(pos << 4 for pos in range(1, bytesPerRead + 1))))
 
     def __init__(self, port='/dev/ttyUSB0', retries = 3, timeout = 3.0):
         self.ser = serial.Serial(
@@ -99,116 +157,236 @@ class Dmm:
             bytesize = serial.EIGHTBITS,
             timeout = timeout)
         self.retries = retries # the number of times it's allowed to retry to get a valid 14 byte read
+        self._rxbuf = bytearray(self.bytesPerRead) # reused for every read
 
+        self._setLowLatency()
         self._synchronize()
 
     def close(self):
         "Close the serial port connection."
         self.ser.close()
 
-    def read(self):
+    def read(self, lazyText=False):
         "Attempt to take a reading from the digital multimeter."
-
+        readAttempt = self._readValidFrame()
+        val, attribs = self._decode(self._rxbuf)
+        return DmmValue(val, attribs, readAttempt, bytes(self._rxbuf), lazyText)
+
+    def iterReadings(self, lazyText=False):
+        """
+        Generator that yields a DmmValue for every reading from the meter.  A
+        background thread reads the serial port while the caller is busy with
+        the previous reading.  If the caller falls behind, the oldest unread
+        readings are dropped rather than queueing up.  Don't call read() while
+        iterating.
+        """
+        frames = queue.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def put(item):
+            while True:
+                try:
+                    frames.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        frames.get_nowait()
+                    except queue.Empty:
+                        pass
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    readAttempt = self._readValidFrame()
+                    # _rxbuf is reused for the next frame so hand over a copy
+                    put((bytearray(self._rxbuf), readAttempt))
+            except Exception as e:
+                # hand the failure over to be raised in the caller's thread
+                put(e)
+
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = frames.get()
+                if isinstance(item, Exception):
+                    raise item
+                buf, readAttempt = item
+                val, attribs = self._decode(buf)
+                yield DmmValue(val, attribs, readAttempt, bytes(buf), lazyText)
+        finally:
+            stop.set()
+            thread.join()
+
+    def _readValidFrame(self):
+        """
+        Read frames into self._rxbuf until one passes validation,
+        resynchronizing after each failure.  Returns the number of failed
+        attempts.
+        """
         # first get a set of bytes and validate it.
         # if the first doesn't validate, synch and get a new set.
-        success = False
-        for readAttempt in xrange(self.retries):
-            bytes = self.ser.read(self.bytesPerRead)
-            if len(bytes) != self.bytesPerRead:
+        buf = self._rxbuf
+        for readAttempt in range(self.retries):
+            if self._readFrame() != self.bytesPerRead:
                 self._synchronize()
                 continue
 
-            for pos, byte in enumerate(bytes, start=1):
-                if ord(byte) // 16 != pos:
-                    self._synchronize()
-                    break
-            else:
-                success = True
-                break
+            if self._isValidFrame(buf):
+                return readAttempt
             
             # if we're here we need to resync and retry
             self._synchronize()
 
-        if not success:
-            raise DmmReadFailure()
-        
-
+        raise DmmReadFailure()
+
+    def _isValidFrame(self, buf):
+        "Check that the high nibble of every byte is its position, 1 to 14."
+        lo, mid, hi = self.frameWords.unpack_from(buf)
+        syncLo, syncMid, syncHi = self.frameSync
+        return (lo & 0xF0F0F0F0F0F0F0F0 == syncLo and
+                mid & 0xF0F0F0F0 == syncMid and
+                hi & 0xF0F0 == syncHi)
+
+    def _readFrame(self):
+        """
+        Read one reading's worth of bytes into self._rxbuf.  Some drivers
+        return early with only part of the burst, so keep reading until all 14
+        bytes are in or the port timeout has passed.  Returns the number of
+        bytes read.
+        """
+        timeout = self.ser.timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        view = memoryview(self._rxbuf)
+        n = self.ser.readinto(view)
+        while n < self.bytesPerRead:
+            if deadline is not None and time.time() > deadline:
+                break
+            more = self.ser.readinto(view[n:])
+            if not more:
+                break
+            n += more
+        return n
+
+    def _decode(self, buf):
+        """
+        Turn a validated 14 byte reading (as a bytearray) into the raw display
+        string and the attribs dict of flags.  Does no I/O.
+        """
+        readDigit = self._readDigit
         val = ''
         for (d1,d2,ch) in self.digits:
-            highBit, digit = self._readDigit(bytes[d1-1], bytes[d2-1])
+            highBit, digit = readDigit(buf[d1-1], buf[d2-1])
             if highBit:
                 val = val + ch
             val = val + digit
 
-        attribs = self._initAttribs()
-        for k,v in self.bits.items():
-            self._readAttribByte(bytes[k-1], v, attribs)
+        readAttribByte = self._readAttribByte
+        attribs = {'flags':[], 'scale':[], 'measure':[], 'other':[]}
+        for k,lut in self.attribLut:
+            readAttribByte(buf[k-1], lut, attribs)
+
+        return val, attribs
+
+    # from linux/serial.h and linux/tty_flags.h
+    TIOCGSERIAL = 0x541E
+    TIOCSSERIAL = 0x541F
+    ASYNC_LOW_LATENCY = 0x2000
+
+    def _setLowLatency(self):
+        """
+        USB serial adapters (FTDI and friends) buffer incoming bytes for up to
+        16ms before handing them to the OS.  Ask the driver to hand them over
+        immediately, falling back to the FTDI latency_timer in sysfs.  Failure
+        is ignored as it only affects how quickly a reading shows up.
+        """
+        if fcntl is None:
+            return
 
-        return DmmValue(val, attribs, readAttempt, bytes)
-                            
+        try:
+            # serial_struct is an int array, flags is the 5th field.  This is
+            # how pyserial itself pokes at it.
+            buf = array.array('i', [0] * 64)
+            fcntl.ioctl(self.ser.fileno(), getattr(termios, 'TIOCGSERIAL', self.TIOCGSERIAL), buf)
+            buf[4] |= self.ASYNC_LOW_LATENCY
+            fcntl.ioctl(self.ser.fileno(), getattr(termios, 'TIOCSSERIAL', self.TIOCSSERIAL), buf)
+            return
+        except (IOError, OSError, ValueError, AttributeError):
+            pass
+
+        try:
+            name = os.path.basename(os.path.realpath(self.ser.port))
+            with open('/sys/bus/usb-serial/devices/%s/latency_timer' % name, 'w') as f:
+                f.write('1')
+        except (IOError, OSError, TypeError, AttributeError):
+            pass
 
     def _synchronize(self):
-        v = self.ser.read(1)
-        if len(v) != 1:
-            raise DmmNoData()
-        n = ord(v)
-        pos = n // 16
-        if pos == 0 or pos == 15:
-            raise DmmInvalidSyncValue()
-
-        bytesNeeded = self.bytesPerRead - pos
-        if bytesNeeded:
-            v = self.ser.read(bytesNeeded)
-            # should we check the validity of these bytes?
-            # the read() function allows an occasional invalid
-            # read without throwing an exception so for now
-            # I'll say no.
-
-
-    bits = {
-        1: [('flags', 'AC'), ('flags', 'DC'), ('flags', 'AUTO'), ('flags', 'RS232')],
-        10:[('scale', 'micro'), ('scale', 'nano'), ('scale', 'kilo'), ('measure', 'diode')],
-        11:[('scale', 'milli'), ('measure', '% (duty-cycle)'), ('scale', 'mega'),
-            ('flags', 'beep')],
-        12:[('measure', 'Farads'), ('measure', 'Ohms'), ('flags', 'REL delta'),
-            ('flags', 'Hold')],
-        13:[('measure', 'Amps'), ('measure', 'volts'), ('measure', 'Hertz'),
-            ('other', 'other_13_1')],
-        14:[('other', 'other_14_4'), ('measure', 'degrees Celcius'), ('other', 'other_14_2'),
-            ('other', 'other_14_1')]}
-
-    digits = [(2,3,'-'), (4,5,'.'), (6,7,'.'), (8,9,'.')]
+        """
+        Readings are 14 byte bursts with ~190ms of silence between them.  Read
+        with a short timeout until the line goes quiet after having seen some
+        data, at which point the next byte will be the start of a reading.
+        """
+        timeout = self.ser.timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        self.ser.timeout = self.syncGap
+        try:
+            seenData = False
+            while True:
+                v = self.ser.read(self.bytesPerRead)
+                if v:
+                    seenData = True
+                elif seenData:
+                    return
+
+                if deadline is not None and time.time() > deadline:
+                    if seenData:
+                        # data never stopped long enough to find a gap
+                        raise DmmInvalidSyncValue()
+                    raise DmmNoData()
+        finally:
+            self.ser.timeout = timeout
+
+
+    # (byte number, flags for bits 8, 4, 2, 1 of its data nibble)
+    bits = (
+        (1, (('flags', 'AC'), ('flags', 'DC'), ('flags', 'AUTO'), ('flags', 'RS232'))),
+        (10,(('scale', 'micro'), ('scale', 'nano'), ('scale', 'kilo'), ('measure', 'diode'))),
+        (11,(('scale', 'milli'), ('measure', '% (duty-cycle)'), ('scale', 'mega'),
+             ('flags', 'beep'))),
+        (12,(('measure', 'Farads'), ('measure', 'Ohms'), ('flags', 'REL delta'),
+             ('flags', 'Hold'))),
+        (13,(('measure', 'Amps'), ('measure', 'volts'), ('measure', 'Hertz'),
+             ('other', 'other_13_1'))),
+        (14,(('other', 'other_14_4'), ('measure', 'degrees Celcius'), ('other', 'other_14_2'),
+             ('other', 'other_14_1'))))
+
+    digits = ((2,3,'-'), (4,5,'.'), (6,7,'.'), (8,9,'.'))
     digitTable = {(0,5):'1', (5,11):'2', (1,15):'3', (2,7):'4', (3,14):'5',
                   (7,14):'6', (1,5):'7', (7,15):'8', (3,15):'9', (7,13):'0',
                   (6,8):'L', (0,0):' '}
 
-    def _initAttribs(self):
-        return {'flags':[], 'scale':[], 'measure':[], 'other':[]}
+    attribLut = _buildAttribLut(bits)
 
-    def _readAttribByte(self, byte, bits, attribs):
-        b = ord(byte) % 16
-        bitVal = 8
-        for (attr, val) in bits:
-            v = b // bitVal
-            if v:
-                b = b - bitVal
-                #print "adding flag type %s, val %s"%(attr, val)
-                attribs[attr].append(val)
-            bitVal //= 2
+    def _readAttribByte(self, byte, lut, attribs):
+        for (attr, val) in lut[byte & 0x0F]:
+            #print("adding flag type %s, val %s"%(attr, val))
+            attribs[attr].append(val)
+
+    digitLut = _buildDigitLut(digitTable)
 
     def _readDigit(self, byte1, byte2):
-        b1 = ord(byte1) % 16
-        highBit = b1 // 8
-        b1 = b1 % 8
-        b2 = ord(byte2) % 16
-        try:
-            digit = self.digitTable[(b1,b2)]
-        except:
-            digit = 'X'
-        return highBit, digit
+        return self.digitLut[((byte1 & 0x0F) << 4) | (byte2 & 0x0F)]
             
 
-class DmmValue:
+class DmmValue(object):
     """
     This is a representation of a single read from the multimeter.
 
@@ -218,7 +396,8 @@ class DmmValue:
        saneValue: True if no sanity checks failed.
     
     High level computed fields:
-       text: Nicely formatted text representation of the value.
+       text: Nicely formatted text representation of the value.  If created
+           with lazyText this isn't built until it is first accessed.
        numericVal: numeric value after SI prefixes applied or None if value is non-numeric.
        measurement: what is being measured.
        delta: True if the meter is in delta mode.
@@ -239,7 +418,7 @@ class DmmValue:
        rawBytes:  the raw, 14 byte bitstream that produced this value.
     
     """
-    def __init__(self, val, attribs, readErrors, rawBytes):
+    def __init__(self, val, attribs, readErrors, rawBytes, lazyText=False):
         self.saneValue = True
         self.rawVal = self.val = val
         self.flags = attribs['flags']
@@ -248,24 +427,28 @@ class DmmValue:
         self.reservedFlags = attribs['other']
         self.readErrors = readErrors
         self.rawBytes = rawBytes
-        self.text = 'Invalid Value'
+        self._text = None
 
         self.processFlags()
         self.processScale()
         self.processMeasurement()
         self.processVal()
 
-        if self.saneValue:
+        if not lazyText:
             self.createTextExpression()
 
+    @property
+    def text(self):
+        if self._text is None:
+            self.createTextExpression()
+        return self._text
+
     def createTextExpression(self):
-        text =  self.deltaText
-        text += self.val
-        text += ' '
-        text += self.scale
-        text += self.measurement
-        text += self.ACDCText
-        self.text = text
+        if not self.saneValue:
+            self._text = 'Invalid Value'
+            return
+        self._text = '%s%s %s%s%s' % (self.deltaText, self.val, self.scale,
+                                      self.measurement, self.ACDCText)
 
     def processFlags(self):
         flags = self.flags
@@ -286,19 +469,16 @@ class DmmValue:
             self.delta = True
             self.deltaText = 'delta '
 
-    scaleTable = {'nano': 0.000000001, 'micro': 0.000001, 'milli': 0.001, 
+    scaleTable = {'': 1.0, 'nano': 0.000000001, 'micro': 0.000001, 'milli': 0.001, 
                   'kilo': 1000.0, 'mega': 1000000.0}
     def processScale(self):
         s = self.scaleFlags
-        self.scale = ''
-        self.multiplier = 1
-
-        if len(s) == 0:
-            return
         if len(s) > 1:
             self.saneValue = False
+            self.scale = ''
+            self.multiplier = 1.0
             return
-        self.scale = s[0]
+        self.scale = s[0] if s else ''
         self.multiplier = self.scaleTable[self.scale]
 
     def processMeasurement(self):
@@ -318,29 +498,37 @@ class DmmValue:
         if v.count('.') > 1:
             self.saneValue = False
             return
+        v = v.strip()
+        if not v:
+            return
 
-        n = None
         try:
             n = float(v)
-        except:
-            pass
+        except ValueError:
+            return
 
-        if n is not None:
-            self.val = '%s'%n  # this should remove leading zeros, spaces etc.
-            self.numericVal = n * self.multiplier
+        # remove leading zeros but keep the digits the meter displayed
+        sign = ''
+        if v[0] == '-':
+            sign, v = '-', v[1:]
+        v = v.lstrip('0')
+        if not v or v[0] == '.':
+            v = '0' + v
+        self.val = sign + v
+        self.numericVal = n * self.multiplier
 
     def __repr__(self):
         return "<DmmValue instance: %s>"%self.text
 
 
-class DmmException:
+class DmmException(Exception):
     "Base exception class for Dmm."
 
 class DmmNoData(DmmException):
     "Read from serial port timed out with no bytes read."
 
 class DmmInvalidSyncValue(DmmException):
-    "Got an invalid byte during syncronization."
+    "Couldn't find the gap between readings during syncronization."
 
 class DmmReadFailure(DmmException):
     "Unable to get a successful read within the number of allowed retries."
@@ -349,10 +537,17 @@ class DmmReadFailure(DmmException):
 def main():
     dmm = Dmm()
 
-    while True:
-        val = dmm.read()
-        print val.text
-        print val.numericVal
+    # only flush after every reading when someone is watching, when piped
+    # let the output buffer so writing doesn't hold up reading.
+    out = sys.stdout
+    write = out.write
+    flush = out.flush
+    interactive = out.isatty()
+
+    for val in dmm.iterReadings():
+        write('%s\n%s\n' % (val.text, val.numericVal))
+        if interactive:
+            flush()
 
 # main hook
 if __name__ == "__main__":